@@ -0,0 +1,614 @@
+# file: jobs.py
+# Durable batch queue. Uploads are stored in SQLite as a job with one row per
+# document and processed by background threads that live outside the
+# Streamlit rerun cycle, so closing the tab or reconnecting does not lose the
+# batch. After a crash/restart, work resumes per document: finished documents
+# are kept and a stored Textract response is never paid for twice. Several
+# processes (e.g. more copies of the UI) may share one JOBS_DB: a claimed
+# document carries a lease its process keeps renewing, and only documents
+# whose lease expired (their process died) are put back in the queue.
+#
+# Large batches can use Textract's async API instead of analyze_document:
+# documents are staged in S3, started with start_document_analysis and
+# collected by one background thread with a bounded number of jobs in flight.
+# The Textract job id is persisted, so a restart resumes polling rather than
+# starting (and paying for) the analysis again.
+import os, re, json, sqlite3, threading, time, uuid, zipfile, hashlib
+from io import BytesIO
+from typing import Dict, Any, List, Tuple, Optional
+
+import pipeline
+import store
+import worker_service
+
+JOBS_DB             = os.getenv("JOBS_DB", "deshmi_jobs.sqlite3")
+JOB_WORKERS         = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS    = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "24"))
+POLL_SECONDS        = 0.5
+SWEEP_SECONDS       = float(os.getenv("JOB_SWEEP_SECONDS", "60"))
+LEASE_SECONDS       = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+ASYNC_TEXTRACT_MIN_BATCH   = int(os.getenv("ASYNC_TEXTRACT_MIN_BATCH", "20"))
+ASYNC_TEXTRACT_MAX_JOBS    = int(os.getenv("ASYNC_TEXTRACT_MAX_JOBS", "25"))   # in flight
+ASYNC_TEXTRACT_POLL_SECONDS = float(os.getenv("ASYNC_TEXTRACT_POLL_SECONDS", "5"))
+# retried later instead of failing the document
+_TEXTRACT_BACKOFF_ERRORS = {"ThrottlingException", "LimitExceededException",
+                            "ProvisionedThroughputExceededException"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    fmt         TEXT NOT NULL,                     -- docx | pdf
+    ocr_mode    TEXT NOT NULL DEFAULT 'sync',      -- sync | async
+    status      TEXT NOT NULL DEFAULT 'queued',    -- queued | done
+    created_at  REAL NOT NULL,
+    finished_at REAL,
+    zip         BLOB
+);
+CREATE TABLE IF NOT EXISTS job_docs (
+    job_id        TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    idx           INTEGER NOT NULL,
+    filename      TEXT NOT NULL,
+    source        BLOB NOT NULL,
+    source_sha256 TEXT,
+    status        TEXT NOT NULL DEFAULT 'pending', -- [ocr_queued | ocr →] pending | running | done | failed | duplicate
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    blocks_json   TEXT,                            -- Textract checkpoint
+    textract_job  TEXT,                            -- async mode: Textract JobId
+    data_json     TEXT,
+    out_bytes     BLOB,
+    out_name      TEXT,
+    error         TEXT,
+    dedup_key     TEXT,                            -- personal_no|request_no
+    dup_of        INTEGER,                         -- idx of the kept document
+    started_at    REAL,
+    finished_at   REAL,
+    ocr_ms        INTEGER,                         -- OCR + extract_fields
+    render_ms     INTEGER,                         -- DOCX (+ PDF)
+    ocr_errors    INTEGER NOT NULL DEFAULT 0,      -- async mode: failed Textract calls
+    lease_owner   TEXT,                            -- process working on a 'running' doc
+    lease_until   REAL,                            -- renewed by that process's heartbeat
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_docs_status ON job_docs(status);
+"""
+
+# columns added after the first release; ALTERed into existing databases
+_ADDED_COLUMNS = [
+    ("job_docs", "source_sha256", "TEXT"),
+    ("job_docs", "dedup_key",     "TEXT"),
+    ("job_docs", "dup_of",        "INTEGER"),
+    ("job_docs", "started_at",    "REAL"),
+    ("job_docs", "finished_at",   "REAL"),
+    ("job_docs", "ocr_ms",        "INTEGER"),
+    ("job_docs", "render_ms",     "INTEGER"),
+    ("jobs",     "ocr_mode",      "TEXT NOT NULL DEFAULT 'sync'"),
+    ("job_docs", "textract_job",  "TEXT"),
+    ("job_docs", "ocr_errors",    "INTEGER NOT NULL DEFAULT 0"),
+    ("job_docs", "lease_owner",   "TEXT"),
+    ("job_docs", "lease_until",   "REAL"),
+]
+
+_start_lock = threading.Lock()
+_started = False
+_OWNER = uuid.uuid4().hex  # this process, as a lease holder
+
+
+def _connect() -> sqlite3.Connection:
+    # autocommit; multi-statement updates use explicit BEGIN IMMEDIATE
+    con = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA foreign_keys=ON")
+    return con
+
+
+def init_db():
+    con = _connect()
+    try:
+        con.executescript(_SCHEMA)
+        for table, column, decl in _ADDED_COLUMNS:
+            have = {r["name"] for r in con.execute(f"PRAGMA table_info({table})")}
+            if column not in have:
+                con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    finally:
+        con.close()
+
+
+def _recover(con: sqlite3.Connection):
+    """Put documents whose process died mid-run (lease expired, or never
+    leased by an older version) back in the queue, or fail them once they
+    have used up their attempts. Documents leased by a live process — this
+    one or another sharing JOBS_DB — are left alone."""
+    expired = "status='running' AND (lease_until IS NULL OR lease_until < ?)"
+    now = time.time()
+    con.execute(f"UPDATE job_docs SET status='failed', error='Tentativa të shumta pa sukses', "
+                f"finished_at=? WHERE {expired} AND attempts >= ?", (now, now, JOB_MAX_ATTEMPTS))
+    con.execute(f"UPDATE job_docs SET status='pending' WHERE {expired}", (now,))
+
+
+def _sweep(con: sqlite3.Connection):
+    """Re-queue documents with an expired lease, finish any job whose last
+    document completed without the job being finalized (e.g. a lock timeout
+    in _finish_job_if_complete), re-queue duplicates of documents that
+    failed, and purge finished jobs past JOB_RETENTION_HOURS. Runs at
+    startup and then every SWEEP_SECONDS."""
+    _recover(con)
+    for r in con.execute("SELECT id FROM jobs WHERE status != 'done'").fetchall():
+        _release_duplicates(con, r["id"])  # keepers failed by _recover/_requeue
+        _finish_job_if_complete(con, r["id"])
+    if JOB_RETENTION_HOURS > 0:
+        cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+        con.execute("DELETE FROM jobs WHERE status='done' AND finished_at < ?", (cutoff,))
+
+
+def start_workers(n: int = JOB_WORKERS):
+    """Start the background workers once per process. Safe to call on every
+    Streamlit rerun — this module stays in sys.modules between reruns."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        init_db()
+        con = _connect()
+        try:
+            _sweep(con)
+        finally:
+            con.close()
+        for i in range(max(1, n)):
+            threading.Thread(target=_worker_loop, name=f"job-worker-{i}", daemon=True).start()
+        threading.Thread(target=_async_ocr_loop, name="job-async-ocr", daemon=True).start()
+        threading.Thread(target=_sweep_loop, name="job-sweep", daemon=True).start()
+        threading.Thread(target=_heartbeat_loop, name="job-heartbeat", daemon=True).start()
+        _started = True
+
+# ────────────────────────────────────────────────────────────────────────────
+# Submit / poll
+# ────────────────────────────────────────────────────────────────────────────
+def sha256_hex(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def dedupe_uploads(files: List[Tuple[str, bytes]]) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, int]]]:
+    """Drop byte-identical files before any OCR is paid for.
+    Returns (unique files, [(dropped filename, index of the kept file in
+    unique files), ...])."""
+    seen: Dict[str, int] = {}
+    unique, dropped = [], []
+    for name, content in files:
+        h = sha256_hex(content)
+        if h in seen:
+            dropped.append((name, seen[h]))
+            continue
+        seen[h] = len(unique)
+        unique.append((name, content))
+    return unique, dropped
+
+
+def submit_job(files: List[Tuple[str, bytes]], fmt: str, ocr_mode: Optional[str] = None,
+               dropped: Optional[List[Tuple[str, int]]] = None) -> str:
+    """files: list of (filename, bytes). fmt: "docx" | "pdf".
+    ocr_mode: "sync" | "async"; by default async is used for batches of at
+    least ASYNC_TEXTRACT_MIN_BATCH when TEXTRACT_S3_BUCKET is set.
+    dropped: byte-identical uploads from dedupe_uploads; they are recorded
+    as 'duplicate' rows (no source kept) so the job reports them alongside
+    the other documents. Returns job id."""
+    if ocr_mode is None:
+        use_async = bool(pipeline.TEXTRACT_S3_BUCKET) and len(files) >= ASYNC_TEXTRACT_MIN_BATCH
+        ocr_mode = "async" if use_async else "sync"
+    job_id = uuid.uuid4().hex
+    con = _connect()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("INSERT INTO jobs (id, fmt, ocr_mode, created_at) VALUES (?, ?, ?, ?)",
+                    (job_id, fmt, ocr_mode, time.time()))
+        con.executemany(
+            "INSERT INTO job_docs (job_id, idx, filename, source, source_sha256, status) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(job_id, i, name, sqlite3.Binary(content), sha256_hex(content),
+              "ocr_queued" if ocr_mode == "async" else "pending")
+             for i, (name, content) in enumerate(files)],
+        )
+        now = time.time()
+        con.executemany(
+            "INSERT INTO job_docs (job_id, idx, filename, source, source_sha256, status, dup_of, "
+            "started_at, finished_at) VALUES (?, ?, ?, ?, ?, 'duplicate', ?, ?, ?)",
+            [(job_id, len(files) + i, name, sqlite3.Binary(b""), sha256_hex(files[kept][1]), kept, now, now)
+             for i, (name, kept) in enumerate(dropped or [])],
+        )
+        con.execute("COMMIT")
+    finally:
+        con.close()
+    return job_id
+
+
+def job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    con = _connect()
+    try:
+        job = con.execute("SELECT id, fmt, status FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        docs = [dict(r) for r in con.execute(
+            "SELECT idx, filename, status, error, dup_of, data_json, out_name, started_at, "
+            "finished_at, ocr_ms, render_ms, length(source) = 0 AS identical "
+            "FROM job_docs WHERE job_id=? ORDER BY idx",
+            (job_id,))]
+    finally:
+        con.close()
+    for d in docs:
+        d["fields"] = json.loads(d.pop("data_json") or "{}")
+        d["identical"] = bool(d["identical"]) and d["status"] == "duplicate"  # dropped at submit
+    return {
+        "id": job["id"], "fmt": job["fmt"], "status": job["status"],
+        "total": len(docs),
+        "finished": sum(d["status"] in ("done", "failed", "duplicate") for d in docs),
+        "docs": docs,
+    }
+
+
+def doc_output(job_id: str, idx: int) -> Optional[Tuple[str, bytes]]:
+    """(filename, bytes) of one finished document, available before the
+    rest of the job completes."""
+    con = _connect()
+    try:
+        row = con.execute("SELECT out_name, out_bytes FROM job_docs "
+                          "WHERE job_id=? AND idx=? AND status='done'", (job_id, idx)).fetchone()
+    finally:
+        con.close()
+    return (row["out_name"], bytes(row["out_bytes"])) if row else None
+
+
+def job_zip(job_id: str) -> Optional[bytes]:
+    con = _connect()
+    try:
+        row = con.execute("SELECT zip FROM jobs WHERE id=? AND status='done'", (job_id,)).fetchone()
+    finally:
+        con.close()
+    return bytes(row["zip"]) if row and row["zip"] is not None else None
+
+# ────────────────────────────────────────────────────────────────────────────
+# Workers
+# ────────────────────────────────────────────────────────────────────────────
+def _claim(con: sqlite3.Connection) -> Optional[sqlite3.Row]:
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        row = con.execute(
+            "SELECT d.job_id, d.idx, d.source, d.source_sha256, d.blocks_json, j.fmt "
+            "FROM job_docs d JOIN jobs j ON j.id = d.job_id "
+            "WHERE d.status='pending' ORDER BY j.created_at, d.idx LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            now = time.time()
+            con.execute("UPDATE job_docs SET status='running', attempts=attempts+1, started_at=COALESCE(started_at, ?), "
+                        "lease_owner=?, lease_until=? WHERE job_id=? AND idx=?",
+                        (now, _OWNER, now + LEASE_SECONDS, row["job_id"], row["idx"]))
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return row
+
+
+def _run_doc(con: sqlite3.Connection, row: sqlite3.Row):
+    key = (row["job_id"], row["idx"])
+    be = worker_service.backend()
+    sha = row["source_sha256"] or sha256_hex(bytes(row["source"]))
+    t0 = time.perf_counter()
+    try:
+        known = None if row["blocks_json"] else _archived(sha)
+        if known is not None:
+            data = known["fields"]  # same original processed before: no OCR
+        else:
+            if row["blocks_json"]:
+                resp = {"Blocks": json.loads(row["blocks_json"])}
+            else:
+                resp = be.run_textract(bytes(row["source"]))
+                # checkpoint the paid OCR call before doing anything else
+                con.execute("UPDATE job_docs SET blocks_json=? WHERE job_id=? AND idx=?",
+                            (json.dumps(resp["Blocks"]), *key))
+            blocks, _ = pipeline.blocks_map(resp)
+            data = pipeline.extract_fields(blocks)
+        # fields show up in the progress table before rendering finishes; an
+        # ocr_ms already set (async collector, earlier attempt) is the real OCR time
+        con.execute("UPDATE job_docs SET data_json=?, ocr_ms=COALESCE(ocr_ms, ?) WHERE job_id=? AND idx=?",
+                    (json.dumps(data, ensure_ascii=False), _ms_since(t0), *key))
+        if _mark_if_duplicate(con, row, data):
+            _finish_job_if_complete(con, row["job_id"])
+            return
+        t1 = time.perf_counter()
+        out_bytes, ext = be.render_output(data, row["fmt"])
+        render_ms = _ms_since(t1)
+        con.execute(
+            "UPDATE job_docs SET status='done', out_bytes=?, out_name=?, error=NULL, "
+            "render_ms=?, finished_at=? WHERE job_id=? AND idx=?",
+            (sqlite3.Binary(out_bytes), pipeline.output_filename(data, ext),
+             render_ms, time.time(), *key),
+        )
+        _archive(sha, data, {ext: out_bytes})
+    except sqlite3.Error:
+        raise  # transient (e.g. locked): _worker_loop re-queues within JOB_MAX_ATTEMPTS
+    except Exception as e:
+        _fail_doc(con, key, f"{type(e).__name__}: {e}")
+    _finish_job_if_complete(con, row["job_id"])
+
+
+def _fail_doc(con: sqlite3.Connection, key: Tuple[str, int], error: str):
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute("UPDATE job_docs SET status='failed', error=?, finished_at=? WHERE job_id=? AND idx=?",
+                    (error, time.time(), *key))
+        _release_duplicates(con, key[0])
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def _archived(sha: str) -> Optional[Dict[str, Any]]:
+    try:
+        return store.get_by_sha(sha)
+    except Exception:
+        return None  # archive unavailable: pay for OCR rather than fail the document
+
+
+def _archive(sha: str, data: Dict[str, str], artifacts: Dict[str, bytes]):
+    try:
+        store.save(sha, data, artifacts)
+    except Exception:
+        pass  # a side effect: the rendered document is already done
+
+
+def _ms_since(t0: float) -> int:
+    return int((time.perf_counter() - t0) * 1000)
+
+
+def _dedup_key(data: Dict[str, str]) -> Optional[str]:
+    personal_no = re.sub(r"\s+", "", data.get("personal_no") or "").upper()
+    request_no  = re.sub(r"\s+", "", data.get("request_no") or "").upper()
+    if not (personal_no and request_no):
+        return None
+    return f"{personal_no}|{request_no}"
+
+
+def _mark_if_duplicate(con: sqlite3.Connection, row: sqlite3.Row, data: Dict[str, str]) -> bool:
+    """Collapse the same certificate uploaded twice in one job (e.g. a scan
+    and the e-Albania PDF). The first document to register its
+    personal_no/request_no is rendered; later ones are marked 'duplicate'
+    and are re-queued if that document fails (_release_duplicates)."""
+    key = _dedup_key(data)
+    if key is None:
+        return False
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        kept = con.execute(
+            "SELECT idx FROM job_docs WHERE job_id=? AND dedup_key=? AND idx != ? "
+            "AND status IN ('running','done') ORDER BY idx LIMIT 1",
+            (row["job_id"], key, row["idx"])).fetchone()
+        if kept is None:
+            con.execute("UPDATE job_docs SET dedup_key=? WHERE job_id=? AND idx=?",
+                        (key, row["job_id"], row["idx"]))
+        else:
+            con.execute("UPDATE job_docs SET status='duplicate', dup_of=?, finished_at=? "
+                        "WHERE job_id=? AND idx=?",
+                        (kept["idx"], time.time(), row["job_id"], row["idx"]))
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return kept is not None
+
+
+def _release_duplicates(con: sqlite3.Connection, job_id: str):
+    # a copy collapsed into a document that then failed goes back to the
+    # queue; the first one to re-register its key is rendered in its place.
+    # Byte-identical drops have no source to re-run (and would fail alike).
+    con.execute(
+        "UPDATE job_docs SET status='pending', dup_of=NULL, finished_at=NULL "
+        "WHERE job_id=? AND status='duplicate' AND length(source) > 0 AND EXISTS (SELECT 1 FROM job_docs k "
+        "WHERE k.job_id=job_docs.job_id AND k.idx=job_docs.dup_of AND k.status='failed')",
+        (job_id,))
+
+
+def _finish_job_if_complete(con: sqlite3.Connection, job_id: str):
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        open_docs = con.execute(
+            "SELECT COUNT(*) FROM job_docs WHERE job_id=? "
+            "AND status IN ('ocr_queued','ocr','pending','running')",
+            (job_id,)).fetchone()[0]
+        job = con.execute("SELECT status FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if open_docs == 0 and job is not None and job["status"] != "done":
+            zip_buf = BytesIO()
+            with zipfile.ZipFile(zip_buf, "w") as zf:
+                used = set()
+                for d in con.execute("SELECT out_name, out_bytes FROM job_docs "
+                                     "WHERE job_id=? AND status='done' ORDER BY idx", (job_id,)):
+                    zf.writestr(_unique_name(d["out_name"], used), bytes(d["out_bytes"]))
+            con.execute("UPDATE jobs SET status='done', finished_at=?, zip=? WHERE id=?",
+                        (time.time(), sqlite3.Binary(zip_buf.getvalue()), job_id))
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def _unique_name(name: str, used: set) -> str:
+    # different people can share a name; never write two ZIP entries alike
+    stem, dot, ext = name.rpartition(".")
+    candidate, n = name, 2
+    while candidate in used:
+        candidate = f"{stem}_{n}{dot}{ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Async Textract collector
+# ────────────────────────────────────────────────────────────────────────────
+def _async_ocr_step(con: sqlite3.Connection) -> int:
+    """One pass: collect finished Textract jobs, then start new ones up to
+    ASYNC_TEXTRACT_MAX_JOBS in flight. Returns the number still in flight."""
+    in_flight = 0
+    for d in con.execute("SELECT job_id, idx, textract_job FROM job_docs "
+                         "WHERE status='ocr' ORDER BY job_id, idx").fetchall():
+        key = (d["job_id"], d["idx"])
+        try:
+            resp = pipeline.get_textract_job(d["textract_job"])
+        except pipeline.TextractJobFailed as e:
+            _fail_async(con, key, f"{type(e).__name__}: {e}")
+            continue
+        except Exception as e:
+            # throttling, 5xx, network: the (paid) job may well still be running
+            if _error_code(e) in _TEXTRACT_BACKOFF_ERRORS or not _count_ocr_error(con, key, e):
+                in_flight += 1
+            continue
+        if resp is None:
+            in_flight += 1
+            continue
+        # hand over to the normal workers, which skip OCR when blocks are stored;
+        # ocr_ms covers start_textract_job → collection, not just extraction
+        # (status guard: another process sharing JOBS_DB may have collected it)
+        con.execute("UPDATE job_docs SET blocks_json=?, status='pending', "
+                    "ocr_ms=CAST((? - started_at) * 1000 AS INTEGER) "
+                    "WHERE job_id=? AND idx=? AND status='ocr'",
+                    (json.dumps(resp["Blocks"]), time.time(), *key))
+        _drop_staged(key)
+
+    free = ASYNC_TEXTRACT_MAX_JOBS - in_flight
+    if free <= 0:
+        return in_flight
+    for d in con.execute(
+            "SELECT d.job_id, d.idx, d.source, d.source_sha256 FROM job_docs d "
+            "JOIN jobs j ON j.id = d.job_id WHERE d.status='ocr_queued' "
+            "ORDER BY j.created_at, d.idx LIMIT ?", (free,)).fetchall():
+        key = (d["job_id"], d["idx"])
+        sha = d["source_sha256"] or sha256_hex(bytes(d["source"]))
+        if _archived(sha) is not None:
+            # processed before: the worker reuses the archived fields
+            con.execute("UPDATE job_docs SET status='pending' WHERE job_id=? AND idx=?", key)
+            continue
+        try:
+            tj = pipeline.start_textract_job(bytes(d["source"]), _staging_id(key))
+        except Exception as e:
+            if _error_code(e) in _TEXTRACT_BACKOFF_ERRORS:
+                break  # over the service limit; try again next pass
+            _count_ocr_error(con, key, e)  # stays 'ocr_queued' until out of attempts
+            continue
+        con.execute("UPDATE job_docs SET status='ocr', textract_job=?, started_at=? "
+                    "WHERE job_id=? AND idx=? AND status='ocr_queued'",
+                    (tj, time.time(), *key))
+        in_flight += 1
+    return in_flight
+
+
+def _count_ocr_error(con: sqlite3.Connection, key: Tuple[str, int], e: Exception) -> bool:
+    """Count a failed Textract call against JOB_MAX_ATTEMPTS; the document
+    keeps its place until then. Returns True once it has been failed."""
+    con.execute("UPDATE job_docs SET ocr_errors=ocr_errors+1 WHERE job_id=? AND idx=?", key)
+    n = con.execute("SELECT ocr_errors FROM job_docs WHERE job_id=? AND idx=?", key).fetchone()[0]
+    if n < JOB_MAX_ATTEMPTS:
+        return False
+    _fail_async(con, key, f"{type(e).__name__}: {e}")
+    return True
+
+
+def _fail_async(con: sqlite3.Connection, key: Tuple[str, int], error: str):
+    con.execute("UPDATE job_docs SET status='failed', error=?, finished_at=? WHERE job_id=? AND idx=?",
+                (error, time.time(), *key))
+    _drop_staged(key)
+    _finish_job_if_complete(con, key[0])
+
+
+def _staging_id(key: Tuple[str, int]) -> str:
+    # per queued document: S3 key and ClientRequestToken (<= 64 chars)
+    return f"{key[0]}-{key[1]}"
+
+
+def _drop_staged(key: Tuple[str, int]):
+    try:
+        pipeline.delete_staged(_staging_id(key))
+    except Exception:
+        pass  # a leftover staging object is harmless (bucket lifecycle rules clean up)
+
+
+def _error_code(e: Exception) -> str:
+    # botocore ClientError carries the AWS error code here
+    return (getattr(e, "response", None) or {}).get("Error", {}).get("Code", "")
+
+
+def _async_ocr_loop():
+    con = _connect()
+    while True:
+        try:
+            in_flight = _async_ocr_step(con)
+        except sqlite3.Error:
+            in_flight = 0
+        time.sleep(ASYNC_TEXTRACT_POLL_SECONDS if in_flight else POLL_SECONDS)
+
+
+def _worker_loop():
+    con = _connect()
+    while True:
+        try:
+            row = _claim(con)
+        except sqlite3.Error:
+            time.sleep(POLL_SECONDS)
+            continue
+        if row is None:
+            time.sleep(POLL_SECONDS)
+            continue
+        try:
+            _run_doc(con, row)
+        except sqlite3.Error:
+            _requeue(con, (row["job_id"], row["idx"]))
+
+
+def _requeue(con: sqlite3.Connection, key: Tuple[str, int], tries: int = 5):
+    """Put a document whose run hit a database error back in the queue (or
+    fail it once out of attempts) instead of leaving it 'running'. A doc that
+    already reached a final status is left alone; _sweep finalizes its job."""
+    for _ in range(tries):
+        _rollback(con)
+        try:
+            con.execute(
+                "UPDATE job_docs SET status=CASE WHEN attempts >= :max THEN 'failed' ELSE 'pending' END, "
+                "error=CASE WHEN attempts >= :max THEN 'Tentativa të shumta pa sukses' ELSE error END, "
+                "finished_at=CASE WHEN attempts >= :max THEN :now ELSE finished_at END "
+                "WHERE job_id=:job_id AND idx=:idx AND status='running'",
+                {"max": JOB_MAX_ATTEMPTS, "now": time.time(), "job_id": key[0], "idx": key[1]})
+            return
+        except sqlite3.Error:
+            time.sleep(POLL_SECONDS)
+
+
+def _rollback(con: sqlite3.Connection):
+    # an interrupted BEGIN IMMEDIATE block may leave the connection mid-transaction
+    if con.in_transaction:
+        try:
+            con.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+
+
+def _sweep_loop():
+    con = _connect()
+    while True:
+        time.sleep(SWEEP_SECONDS)
+        try:
+            _sweep(con)
+        except sqlite3.Error:
+            _rollback(con)
+
+
+def _heartbeat_loop():
+    # renew this process's leases; if it dies they expire and _sweep re-queues
+    con = _connect()
+    while True:
+        time.sleep(LEASE_SECONDS / 3)
+        try:
+            con.execute("UPDATE job_docs SET lease_until=? WHERE status='running' AND lease_owner=?",
+                        (time.time() + LEASE_SECONDS, _OWNER))
+        except sqlite3.Error:
+            pass
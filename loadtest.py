@@ -0,0 +1,222 @@
+# file: loadtest.py
+# Concurrent-session load test. Each simulated session uploads batches of
+# recorded certificates through the same code paths deshmi.py uses (the
+# durable job queue for batches, or the inline single-file path), with
+# Textract replaced by a latency-injecting stub (sync or async API) and,
+# optionally, the LibreOffice conversion stubbed too. Streamlit's own
+# websocket/rerun overhead is not part of the measurement.
+#
+#   python loadtest.py recordings/ --concurrency 1,2,4,8,16 --batch-size 5 \
+#       --textract-latency 1.5 --stub-pdf 0.8 --format pdf
+import os, sys, json, copy, time, random, argparse, tempfile, threading, resource
+from typing import Dict, Any, List, Tuple
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is KB on Linux, bytes on macOS
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / (1024 * 1024) if sys.platform == "darwin" else r / 1024
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.interval, self.peak = interval, _rss_mb()
+        self._stop_evt = threading.Event()
+
+    def run(self):
+        while not self._stop_evt.wait(self.interval):
+            self.peak = max(self.peak, _rss_mb())
+
+    def stop(self) -> float:
+        self._stop_evt.set()
+        self.join()
+        return self.peak
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def load_recordings(path: str) -> List[Dict[str, Any]]:
+    files = [path] if os.path.isfile(path) else sorted(
+        os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json"))
+    recs = []
+    for fp in files:
+        with open(fp, encoding="utf-8") as f:
+            recs.append(json.load(f))
+    if not recs:
+        raise SystemExit(f"No Textract recordings (*.json) in {path}")
+    return recs
+
+
+class Uploads:
+    """Hands out upload bodies. Each is a recorded response plus a unique
+    nonce, so RecordedTextract replays it while byte-dedup and the archive's
+    source-hash lookup still see a new document every time."""
+
+    def __init__(self, recordings: List[Dict[str, Any]]):
+        self.recordings = recordings
+        self._n = 0
+        self._lock = threading.Lock()
+
+    def batch(self, size: int) -> List[Tuple[str, bytes]]:
+        # without replacement where possible, so in-batch dedup stays out of the way
+        picks = random.sample(self.recordings, min(size, len(self.recordings)))
+        picks += random.choices(self.recordings, k=size - len(picks))
+        out = []
+        for rec in picks:
+            with self._lock:
+                self._n += 1
+                n = self._n
+            body = copy.copy(rec)
+            body["LoadTestNonce"] = n
+            out.append((f"cert_{n}.pdf", json.dumps(body).encode("utf-8")))
+        return out
+
+
+def run_session(mode: str, uploads: Uploads, args, results: List[Dict[str, Any]], lock: threading.Lock):
+    import jobs, pipeline
+    for _ in range(args.batches_per_session):
+        files = uploads.batch(args.batch_size)
+        t0 = time.perf_counter()
+        first, failed = None, 0
+        if mode == "queue":
+            job_id = jobs.submit_job(files, args.format, "async" if args.async_ocr else "sync")
+            while True:
+                info = jobs.job_status(job_id)
+                if first is None and any(d["status"] == "done" for d in info["docs"]):
+                    first = time.perf_counter() - t0
+                if info["status"] == "done":
+                    jobs.job_zip(job_id)
+                    failed = sum(d["status"] == "failed" for d in info["docs"])
+                    break
+                time.sleep(args.poll)
+        else:
+            for _, content in files:
+                try:
+                    pipeline.process_one(content, args.format)
+                except Exception:
+                    failed += 1
+                if first is None:
+                    first = time.perf_counter() - t0
+        elapsed = time.perf_counter() - t0
+        with lock:
+            results.append({"latency": elapsed, "ttfr": first if first is not None else elapsed,
+                            "docs": len(files), "failed": failed})
+
+
+def run_level(concurrency: int, mode: str, uploads: Uploads, args) -> Dict[str, Any]:
+    results, lock = [], threading.Lock()
+    sampler = RssSampler()
+    sampler.start()
+    t0 = time.perf_counter()
+    sessions = [threading.Thread(target=run_session, args=(mode, uploads, args, results, lock))
+                for _ in range(concurrency)]
+    for s in sessions:
+        s.start()
+    for s in sessions:
+        s.join()
+    wall = time.perf_counter() - t0
+    lat = [r["latency"] for r in results]
+    docs = sum(r["docs"] for r in results)
+    return {
+        "concurrency": concurrency,
+        "batches": len(results),
+        "docs": docs,
+        "failed": sum(r["failed"] for r in results),
+        "wall_s": wall,
+        "docs_per_s": docs / wall if wall else 0.0,
+        "p50_s": percentile(lat, 50), "p95_s": percentile(lat, 95), "p99_s": percentile(lat, 99),
+        "ttfr_p50_s": percentile([r["ttfr"] for r in results], 50),
+        "peak_rss_mb": sampler.stop(),
+    }
+
+
+def saturation_point(levels: List[Dict[str, Any]], min_gain: float = 0.10, p95_factor: float = 2.0):
+    """First concurrency level whose throughput gain over the previous level
+    is below `min_gain`, or whose p95 exceeds `p95_factor` × the first
+    level's p95. None if the sweep never saturated."""
+    for prev, cur in zip(levels, levels[1:]):
+        gain = (cur["docs_per_s"] - prev["docs_per_s"]) / prev["docs_per_s"] if prev["docs_per_s"] else 0.0
+        if gain < min_gain or cur["p95_s"] > p95_factor * levels[0]["p95_s"]:
+            return cur["concurrency"]
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Concurrent-session load test with stubbed OCR/conversion")
+    ap.add_argument("recordings", help="Textract response JSON file or directory of *.json")
+    ap.add_argument("--concurrency", default="1,2,4,8,16", help="comma-separated session counts")
+    ap.add_argument("--mode", choices=["queue", "inline"], default="queue",
+                    help="queue: batches through jobs.py (default); inline: single-file path per document")
+    ap.add_argument("--batch-size", type=int, default=5)
+    ap.add_argument("--batches-per-session", type=int, default=3)
+    ap.add_argument("--format", choices=["docx", "pdf"], default="docx")
+    ap.add_argument("--textract-latency", type=float, default=1.0, help="seconds per analyze_document")
+    ap.add_argument("--textract-jitter", type=float, default=0.3)
+    ap.add_argument("--async-ocr", action="store_true",
+                    help="queue mode: use the async Textract path against in-memory S3/Textract stand-ins")
+    ap.add_argument("--async-latency", type=float, default=5.0,
+                    help="seconds an async Textract job stays IN_PROGRESS")
+    ap.add_argument("--stub-pdf", type=float, metavar="SECONDS",
+                    help="stub docx_to_pdf_bytes with this latency instead of running LibreOffice")
+    ap.add_argument("--job-workers", type=int, default=int(os.getenv("JOB_WORKERS", "2")))
+    ap.add_argument("--render-cache", action="store_true",
+                    help="keep the render cache on (off by default so every document pays for rendering)")
+    ap.add_argument("--poll", type=float, default=0.25, help="job status poll interval (s)")
+    ap.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = ap.parse_args()
+
+    # throwaway databases, set before jobs/store read their env at import
+    tmp = tempfile.mkdtemp(prefix="deshmi-loadtest-")
+    os.environ["JOBS_DB"] = os.path.join(tmp, "jobs.sqlite3")
+    os.environ["STORE_DB"] = os.path.join(tmp, "store.sqlite3")
+    os.environ.pop("WORKER_URL", None)
+    if args.async_ocr:
+        os.environ.setdefault("TEXTRACT_S3_BUCKET", "loadtest")
+        os.environ.setdefault("ASYNC_TEXTRACT_POLL_SECONDS", "0.5")
+
+    import pipeline, jobs, stubs
+    pipeline.s3 = stubs.LocalS3()
+    pipeline.textract = stubs.RecordedTextract({}, latency=args.textract_latency, jitter=args.textract_jitter,
+                                               s3=pipeline.s3, async_latency=args.async_latency)
+    if args.stub_pdf is not None:
+        pipeline.docx_to_pdf_bytes = stubs.stub_docx_to_pdf(args.stub_pdf)
+    if not args.render_cache:
+        pipeline.render_cache.max_bytes = 0
+    if args.mode == "queue":
+        jobs.start_workers(args.job_workers)
+
+    uploads = Uploads(load_recordings(args.recordings))
+    levels = []
+    print(f"{'conc':>5} {'batches':>7} {'docs':>5} {'fail':>4} {'docs/s':>7} "
+          f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'ttfr50':>7} {'RSS MB':>7}")
+    for c in [int(x) for x in args.concurrency.split(",") if x.strip()]:
+        r = run_level(c, args.mode, uploads, args)
+        levels.append(r)
+        print(f"{r['concurrency']:>5} {r['batches']:>7} {r['docs']:>5} {r['failed']:>4} "
+              f"{r['docs_per_s']:>7.2f} {r['p50_s']:>7.2f} {r['p95_s']:>7.2f} {r['p99_s']:>7.2f} "
+              f"{r['ttfr_p50_s']:>7.2f} {r['peak_rss_mb']:>7.1f}", flush=True)
+
+    sat = saturation_point(levels)
+    print(f"saturation: {'concurrency ' + str(sat) if sat else 'not reached in this sweep'}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": levels, "saturation": sat}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
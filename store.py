@@ -0,0 +1,186 @@
+# file: store.py
+# Indexed archive of every processed certificate, so a returning client can
+# get another copy (or the other format) by searching for them — no upload,
+# OCR or extraction. Also lets a re-uploaded original skip OCR entirely.
+import os, re, json, sqlite3, time
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+import pipeline
+
+STORE_DB = os.getenv("STORE_DB", "deshmi_store.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificates (
+    id            INTEGER PRIMARY KEY,
+    source_sha256 TEXT NOT NULL UNIQUE,
+    request_no    TEXT NOT NULL,
+    personal_no   TEXT NOT NULL,
+    name          TEXT NOT NULL,
+    surname       TEXT NOT NULL,
+    name_key      TEXT NOT NULL,   -- search keys: upper-case, ë/ç folded
+    surname_key   TEXT NOT NULL,
+    fields_json   TEXT NOT NULL,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS certificates_personal_no ON certificates(personal_no);
+CREATE INDEX IF NOT EXISTS certificates_request_no  ON certificates(request_no);
+CREATE INDEX IF NOT EXISTS certificates_name_key    ON certificates(name_key, surname_key);
+CREATE INDEX IF NOT EXISTS certificates_surname_key ON certificates(surname_key);
+CREATE TABLE IF NOT EXISTS artifacts (
+    cert_id          INTEGER NOT NULL REFERENCES certificates(id) ON DELETE CASCADE,
+    fmt              TEXT NOT NULL,   -- docx | pdf
+    renderer_version TEXT NOT NULL,
+    rendered_on      TEXT NOT NULL,   -- YYYY-MM-DD; the translation is dated
+    content          BLOB NOT NULL,
+    PRIMARY KEY (cert_id, fmt)
+);
+"""
+
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+    con = sqlite3.connect(STORE_DB, timeout=30, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA foreign_keys=ON")
+    if not _initialized:
+        con.executescript(_SCHEMA)
+        _initialized = True
+    return con
+
+
+_FOLD = str.maketrans("ëËçÇ", "eEcC")
+
+def _key(s: str) -> str:
+    s = (s or "").strip().translate(_FOLD).upper()
+    return re.sub(r"\s+", " ", s)
+
+
+def _id_key(s: str) -> str:
+    return re.sub(r"\s+", "", s or "").upper()
+
+# ────────────────────────────────────────────────────────────────────────────
+# Write
+# ────────────────────────────────────────────────────────────────────────────
+def save(source_sha256: str, data: Dict[str,str], artifacts: Optional[Dict[str, bytes]] = None) -> int:
+    """Insert or refresh a certificate (by source hash) and any rendered
+    artifacts ({"docx": bytes, "pdf": bytes}). Returns the certificate id."""
+    now = time.time()
+    con = _connect()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute(
+            "INSERT INTO certificates (source_sha256, request_no, personal_no, name, surname, "
+            "name_key, surname_key, fields_json, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(source_sha256) DO UPDATE SET request_no=excluded.request_no, "
+            "personal_no=excluded.personal_no, name=excluded.name, surname=excluded.surname, "
+            "name_key=excluded.name_key, surname_key=excluded.surname_key, "
+            "fields_json=excluded.fields_json, updated_at=excluded.updated_at",
+            (source_sha256, _id_key(data.get("request_no")), _id_key(data.get("personal_no")),
+             (data.get("name") or "").strip(), (data.get("surname") or "").strip(),
+             _key(data.get("name")), _key(data.get("surname")),
+             json.dumps(data, ensure_ascii=False), now, now),
+        )
+        cert_id = con.execute("SELECT id FROM certificates WHERE source_sha256=?",
+                              (source_sha256,)).fetchone()["id"]
+        for fmt, content in (artifacts or {}).items():
+            _put_artifact(con, cert_id, fmt, content)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    return cert_id
+
+
+def _put_artifact(con: sqlite3.Connection, cert_id: int, fmt: str, content: bytes):
+    con.execute(
+        "INSERT OR REPLACE INTO artifacts (cert_id, fmt, renderer_version, rendered_on, content) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (cert_id, fmt, pipeline.RENDERER_VERSION, pipeline.render_day(),
+         sqlite3.Binary(content)),
+    )
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Read
+# ────────────────────────────────────────────────────────────────────────────
+def _row_to_dict(r: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": r["id"], "request_no": r["request_no"], "personal_no": r["personal_no"],
+        "name": r["name"], "surname": r["surname"],
+        "updated_at": r["updated_at"], "fields": json.loads(r["fields_json"]),
+    }
+
+
+def get_by_sha(source_sha256: str) -> Optional[Dict[str, Any]]:
+    con = _connect()
+    try:
+        r = con.execute("SELECT * FROM certificates WHERE source_sha256=?", (source_sha256,)).fetchone()
+    finally:
+        con.close()
+    return _row_to_dict(r) if r else None
+
+
+def get(cert_id: int) -> Optional[Dict[str, Any]]:
+    con = _connect()
+    try:
+        r = con.execute("SELECT * FROM certificates WHERE id=?", (cert_id,)).fetchone()
+    finally:
+        con.close()
+    return _row_to_dict(r) if r else None
+
+
+def search(query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Prefix lookup on personal number, request number, name or surname;
+    "NAME SURN" matches name exactly + surname prefix. Every branch is an
+    index range scan."""
+    q_id, q = _id_key(query), _key(query)
+    if not q:
+        return []
+    hi = "\U0010ffff"
+    branches = [
+        ("personal_no >= ? AND personal_no < ?", (q_id, q_id + hi)),
+        ("request_no >= ? AND request_no < ?",   (q_id, q_id + hi)),
+        ("name_key >= ? AND name_key < ?",       (q, q + hi)),
+        ("surname_key >= ? AND surname_key < ?", (q, q + hi)),
+    ]
+    if " " in q:
+        first, rest = q.split(" ", 1)
+        branches.append(("name_key = ? AND surname_key >= ? AND surname_key < ?", (first, rest, rest + hi)))
+    sql = " UNION ".join(f"SELECT * FROM certificates WHERE {w}" for w, _ in branches)
+    params = [p for _, ps in branches for p in ps]
+    con = _connect()
+    try:
+        rows = con.execute(f"{sql} ORDER BY updated_at DESC LIMIT ?", (*params, limit)).fetchall()
+    finally:
+        con.close()
+    return [_row_to_dict(r) for r in rows]
+
+
+def reissue(cert_id: int, fmt: str,
+            render_output: Callable[[Dict[str,str], str], Tuple[bytes, str]]) -> Tuple[Dict[str,str], bytes]:
+    """Return (fields, bytes) for another copy. A stored artifact is reused
+    when it was rendered today by the current renderer (the translator's
+    statement carries the date); otherwise it is re-rendered and stored."""
+    con = _connect()
+    try:
+        cert = con.execute("SELECT fields_json FROM certificates WHERE id=?", (cert_id,)).fetchone()
+        if cert is None:
+            raise KeyError(f"certificate {cert_id} not found")
+        data = json.loads(cert["fields_json"])
+        art = con.execute(
+            "SELECT content FROM artifacts WHERE cert_id=? AND fmt=? AND renderer_version=? AND rendered_on=?",
+            (cert_id, fmt, pipeline.RENDERER_VERSION, pipeline.render_day())).fetchone()
+        if art is not None:
+            return data, bytes(art["content"])
+        content, _ = render_output(data, fmt)
+        _put_artifact(con, cert_id, fmt, content)
+        return data, content
+    finally:
+        con.close()
@@ -0,0 +1,162 @@
+# file: stubs.py
+# Local stand-ins for AWS services so the pipeline can be run end-to-end on a
+# single machine without credentials (or Textract costs). For a networked
+# stand-in instead (moto server, LocalStack), point AWS_ENDPOINT_URL at it —
+# boto3 picks that up for the real clients in pipeline.py.
+import os, json, glob, hashlib, random, time, uuid, threading
+from typing import Dict, Any, Optional
+
+
+class RecordedTextract:
+    """Drop-in for the boto3 Textract client (``pipeline.textract``) that
+    replays recorded ``analyze_document`` responses.
+
+    A recordings directory holds Textract responses as ``<stem>.json``. If
+    the original document sits next to it (``<stem>.pdf/.jpg/.jpeg/.png``)
+    uploads of that exact file get its recording. An upload that is itself a
+    recorded response (JSON with "Blocks") is replayed as-is. With a single
+    recording, every upload gets it.
+
+    ``latency``/``jitter`` (seconds) inject a uniform delay per call to
+    mimic the real service under load. The async API
+    (start/get_document_analysis) reads documents from a ``LocalS3`` and
+    reports IN_PROGRESS until ``async_latency`` seconds have passed."""
+
+    _DOC_EXTS = (".pdf", ".jpg", ".jpeg", ".png")
+
+    def __init__(self, recordings: Dict[str, Dict[str, Any]], default: Optional[Dict[str, Any]] = None,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 s3: Optional["LocalS3"] = None, async_latency: float = 0.0, page_size: int = 1000):
+        self.recordings = recordings  # sha256 of original document → response
+        self.default = default
+        self.latency = latency
+        self.jitter = jitter
+        self.s3 = s3
+        self.async_latency = async_latency
+        self.page_size = page_size
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._tokens: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_path(cls, path: str, **kwargs) -> "RecordedTextract":
+        files = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, "*.json")))
+        if not files:
+            raise FileNotFoundError(f"No Textract recordings (*.json) in {path}")
+        recordings, responses = {}, []
+        for fp in files:
+            with open(fp, encoding="utf-8") as f:
+                resp = json.load(f)
+            responses.append(resp)
+            stem = os.path.splitext(fp)[0]
+            for ext in cls._DOC_EXTS:
+                if os.path.exists(stem + ext):
+                    with open(stem + ext, "rb") as f:
+                        recordings[hashlib.sha256(f.read()).hexdigest()] = resp
+        return cls(recordings, default=responses[0] if len(responses) == 1 else None, **kwargs)
+
+    def _lookup(self, file_bytes: bytes) -> Dict[str, Any]:
+        resp = self.recordings.get(hashlib.sha256(file_bytes).hexdigest())
+        if resp is not None:
+            return resp
+        try:
+            resp = json.loads(file_bytes)
+        except ValueError:
+            resp = None
+        if isinstance(resp, dict) and "Blocks" in resp:
+            return resp
+        if self.default is not None:
+            return self.default
+        raise ValueError("RecordedTextract: no recording for this document")
+
+    def _delay(self):
+        _sleep(self.latency, self.jitter)
+
+    def analyze_document(self, Document: Dict[str, Any], FeatureTypes=None, **kwargs) -> Dict[str, Any]:
+        self._delay()
+        return self._lookup(Document["Bytes"])
+
+    def start_document_analysis(self, DocumentLocation: Dict[str, Any], FeatureTypes=None,
+                                ClientRequestToken: Optional[str] = None, **kwargs) -> Dict[str, str]:
+        self._delay()
+        with self._lock:
+            if ClientRequestToken and ClientRequestToken in self._tokens:
+                return {"JobId": self._tokens[ClientRequestToken]}  # idempotent, like the service
+            obj = DocumentLocation["S3Object"]
+            job_id = uuid.uuid4().hex
+            try:
+                job = {"resp": self._lookup(self.s3.get_object(Bucket=obj["Bucket"], Key=obj["Name"])["Body"].read())}
+            except Exception as e:
+                job = {"error": str(e)}
+            job["ready_at"] = time.monotonic() + self.async_latency
+            self._jobs[job_id] = job
+            if ClientRequestToken:
+                self._tokens[ClientRequestToken] = job_id
+        return {"JobId": job_id}
+
+    def get_document_analysis(self, JobId: str, MaxResults: int = 1000,
+                              NextToken: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        self._delay()
+        job = self._jobs[JobId]
+        if time.monotonic() < job["ready_at"]:
+            return {"JobStatus": "IN_PROGRESS"}
+        if "error" in job:
+            return {"JobStatus": "FAILED", "StatusMessage": job["error"]}
+        blocks = job["resp"]["Blocks"]
+        start = int(NextToken or 0)
+        end = start + min(MaxResults, self.page_size)
+        out = {"JobStatus": "SUCCEEDED", "Blocks": blocks[start:end]}
+        if end < len(blocks):
+            out["NextToken"] = str(end)
+        return out
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+
+class LocalS3:
+    """In-memory stand-in for the few boto3 S3 calls the async OCR path uses."""
+
+    def __init__(self):
+        self.objects: Dict[tuple, bytes] = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        with self._lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise KeyError(f"NoSuchKey: s3://{Bucket}/{Key}")
+            return {"Body": _Body(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+def _sleep(latency: float, jitter: float):
+    if latency > 0 or jitter > 0:
+        time.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+
+
+# smallest well-formed PDF; enough for download/ZIP paths
+_MINIMAL_PDF = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+                b"2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\n"
+                b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+def stub_docx_to_pdf(latency: float = 0.0, jitter: float = 0.0):
+    """Replacement for ``pipeline.docx_to_pdf_bytes`` that skips LibreOffice
+    and returns a placeholder PDF after an injected delay."""
+    def docx_to_pdf_bytes(docx_bytes: bytes) -> bytes:
+        _sleep(latency, jitter)
+        return _MINIMAL_PDF
+    return docx_to_pdf_bytes
@@ -0,0 +1,263 @@
+# file: worker_service.py
+# Stateless HTTP service around the pipeline (OCR → extract_fields →
+# build_docx → PDF), so processing can be scaled out as N worker processes or
+# nodes behind a load balancer while the Streamlit UI stays thin.
+#
+#   python worker_service.py --port 8601 --processes 4
+#   python worker_service.py --stub-textract recordings/   # no AWS needed
+#
+# The UI/job workers use it when WORKER_URL is set (e.g. http://127.0.0.1:8601).
+#
+# Endpoints
+#   GET  /healthz
+#   POST /v1/process?format=docx|pdf   body: document bytes        → JSON result
+#   POST /v1/batch                     body: {"format", "documents": [{"filename", "content_b64"}]}
+#   POST /v1/ocr                       body: document bytes        → {"Blocks": [...]}
+#   POST /v1/render?format=docx|pdf    body: extract_fields JSON   → rendered bytes
+import os, json, base64, argparse, signal
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, Any, List, Tuple
+
+import pipeline
+
+WORKER_URL        = os.getenv("WORKER_URL", "").rstrip("/")
+WORKER_POOL_SIZE  = int(os.getenv("WORKER_POOL_SIZE", "8"))
+WORKER_TIMEOUT    = float(os.getenv("WORKER_TIMEOUT", "180"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+MAX_BODY_MB       = float(os.getenv("MAX_BODY_MB", "50"))
+
+# ────────────────────────────────────────────────────────────────────────────
+# Server
+# ────────────────────────────────────────────────────────────────────────────
+def _result_json(data: Dict[str,str], out_bytes: bytes, ext: str) -> Dict[str, Any]:
+    return {
+        "fields": data,
+        "ext": ext,
+        "output_name": pipeline.output_filename(data, ext),
+        "content_b64": base64.b64encode(out_bytes).decode("ascii"),
+    }
+
+
+def _json_object(body: bytes) -> Dict[str, Any]:
+    value = json.loads(body)
+    if not isinstance(value, dict):
+        raise ValueError("body must be a JSON object")
+    return value
+
+
+def _fmt(value: str) -> str:
+    if value not in ("docx", "pdf"):
+        raise ValueError(f"format must be 'docx' or 'pdf', not {value!r}")
+    return value
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive for the pooled client
+    server_version = "DeshmiWorker/1"
+    quiet = True
+
+    def log_message(self, fmt, *args):
+        if not self.quiet:
+            super().log_message(fmt, *args)
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj: Any):
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"),
+                   "application/json; charset=utf-8")
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_MB * 1024 * 1024:
+            raise OverflowError(f"body larger than {MAX_BODY_MB:g} MB")
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/healthz":
+            self._send_json(200, {"ok": True, "pid": os.getpid()})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            body = self._body()
+        except OverflowError as e:
+            self.close_connection = True
+            return self._send_json(413, {"error": str(e)})
+        try:
+            if url.path == "/v1/process":
+                data, out_bytes, ext = pipeline.process_one(body, _fmt(query.get("format", "docx")))
+                self._send_json(200, _result_json(data, out_bytes, ext))
+            elif url.path == "/v1/batch":
+                self._send_json(200, {"results": self._batch(_json_object(body))})
+            elif url.path == "/v1/ocr":
+                resp = pipeline.run_textract(body)
+                self._send_json(200, {"Blocks": resp["Blocks"]})
+            elif url.path == "/v1/render":
+                data = _json_object(body)
+                if not all(isinstance(v, str) for v in data.values()):
+                    raise ValueError("field values must be strings")
+                out_bytes, ext = pipeline.render_output(data, _fmt(query.get("format", "docx")))
+                self._send(200, out_bytes, pipeline.MIME_TYPES[ext])
+            else:
+                self._send_json(404, {"error": "not found"})
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _batch(self, req: Dict[str, Any]) -> List[Dict[str, Any]]:
+        fmt = _fmt(req.get("format", "docx"))
+        docs = req["documents"]
+        if not (isinstance(docs, list) and all(isinstance(d, dict) for d in docs)):
+            raise ValueError("documents must be a list of objects")
+
+        def one(doc):
+            try:
+                data, out_bytes, ext = pipeline.process_one(base64.b64decode(doc["content_b64"]), fmt)
+                return {"filename": doc.get("filename"), "ok": True, **_result_json(data, out_bytes, ext)}
+            except Exception as e:  # one bad document must not fail the batch
+                return {"filename": doc.get("filename"), "ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        with ThreadPoolExecutor(max_workers=max(1, BATCH_CONCURRENCY)) as ex:
+            return list(ex.map(one, docs))
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(host: str, port: int, processes: int = 1, verbose: bool = False):
+    """Serve on host:port. With processes > 1 the listening socket is bound
+    once and shared by forked children (the kernel spreads connections); on
+    SIGTERM/Ctrl-C the parent stops its children and waits for them."""
+    Handler.quiet = not verbose
+    server = ThreadingHTTPServer((host, port), Handler)  # SO_REUSEADDR set before bind
+    children: List[int] = []
+    for _ in range(max(1, processes) - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = []  # only the parent supervises
+            break
+        children.append(pid)
+    signal.signal(signal.SIGTERM, _interrupt)
+    print(f"[worker {os.getpid()}] listening on http://{host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+# ────────────────────────────────────────────────────────────────────────────
+# Client
+# ────────────────────────────────────────────────────────────────────────────
+class WorkerError(RuntimeError):
+    pass
+
+
+class WorkerClient:
+    """Pooled HTTP client with the same call shape as the pipeline module
+    (run_textract / extract_one / render_output / process_one), so callers can
+    use either interchangeably."""
+
+    def __init__(self, base_url: str, pool_size: int = WORKER_POOL_SIZE, timeout: float = WORKER_TIMEOUT):
+        import urllib3
+        self.base_url = base_url.rstrip("/")
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size, block=True,
+            timeout=urllib3.Timeout(connect=5.0, read=timeout),
+            # only retry failures to connect — a read retry could re-pay OCR
+            retries=urllib3.Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2),
+        )
+
+    def _post(self, path: str, body: bytes, content_type: str, **params):
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        r = self.http.request("POST", f"{self.base_url}{path}" + (f"?{query}" if query else ""),
+                              body=body, headers={"Content-Type": content_type})
+        if r.status != 200:
+            try:
+                msg = json.loads(r.data)["error"]
+            except Exception:
+                msg = r.data[:200].decode("utf-8", "replace")
+            raise WorkerError(f"{path} → HTTP {r.status}: {msg}")
+        return r
+
+    def run_textract(self, file_bytes: bytes) -> Dict[str, Any]:
+        return json.loads(self._post("/v1/ocr", file_bytes, "application/octet-stream").data)
+
+    def extract_one(self, file_bytes: bytes) -> Dict[str,str]:
+        blocks, _ = pipeline.blocks_map(self.run_textract(file_bytes))
+        return pipeline.extract_fields(blocks)
+
+    def render_output(self, data: Dict[str,str], fmt: str) -> Tuple[bytes, str]:
+        # check the local render cache first; the worker keeps its own as well
+        key = pipeline.render_key(data, fmt, pipeline.render_day())
+        hit = pipeline.render_cache.get(key)
+        if hit is not None:
+            return hit, fmt
+        out_bytes = self._post("/v1/render", json.dumps(data, ensure_ascii=False).encode("utf-8"),
+                               "application/json", format=fmt).data
+        pipeline.render_cache.put(key, out_bytes)
+        return out_bytes, fmt
+
+    def process_one(self, file_bytes: bytes, fmt: str) -> Tuple[Dict[str,str], bytes, str]:
+        res = json.loads(self._post("/v1/process", file_bytes, "application/octet-stream", format=fmt).data)
+        return res["fields"], base64.b64decode(res["content_b64"]), res["ext"]
+
+    def process_batch(self, files: List[Tuple[str, bytes]], fmt: str) -> List[Dict[str, Any]]:
+        req = {"format": fmt, "documents": [
+            {"filename": name, "content_b64": base64.b64encode(content).decode("ascii")}
+            for name, content in files]}
+        res = json.loads(self._post("/v1/batch", json.dumps(req).encode("utf-8"), "application/json").data)
+        for r in res["results"]:
+            if r.get("ok"):
+                r["content"] = base64.b64decode(r.pop("content_b64"))
+        return res["results"]
+
+
+_client = None
+
+def backend():
+    """The remote worker client when WORKER_URL is set, else the in-process
+    pipeline module."""
+    global _client
+    if not WORKER_URL:
+        return pipeline
+    if _client is None:
+        _client = WorkerClient(WORKER_URL)
+    return _client
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Deshmi pipeline worker service")
+    ap.add_argument("--host", default=os.getenv("WORKER_HOST", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("WORKER_PORT", "8601")))
+    ap.add_argument("--processes", type=int, default=1, help="forked processes sharing the port")
+    ap.add_argument("--stub-textract", metavar="PATH",
+                    help="replay recorded Textract responses from PATH (file or directory) instead of AWS")
+    ap.add_argument("--verbose", action="store_true", help="log every request")
+    args = ap.parse_args()
+    if args.stub_textract:
+        import stubs
+        pipeline.textract = stubs.RecordedTextract.from_path(args.stub_textract)
+    serve(args.host, args.port, args.processes, args.verbose)